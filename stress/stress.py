@@ -4,42 +4,128 @@ A trivial utility for consuming system resources.
 from __future__ import print_function
 
 import argparse
+import ctypes
+import mmap
 import multiprocessing
+import multiprocessing.connection
+import os
 import psutil
 import signal
 import sys
 import time
 import tempfile
+import threading
 
+PAGE_SIZE = mmap.PAGESIZE
+TOUCH_BLOCK_SIZE = 256 * 1024
+TOUCH_PASSES = 4
+IO_CHUNK_SIZE = 64 * 1024
+IO_BATCH_SIZE = 32
+RESPAWN_MIN_UPTIME = 5
+RESPAWN_BACKOFF = 2
+BARRIER_TIMEOUT = 10
 
-def _spin(ram_per_core_mb):
+# prctl option from <linux/prctl.h>
+_PR_SET_PDEATHSIG = 1
+
+# Translation table that adds one (mod 256) to each byte
+_INCREMENT = bytes((b + 1) % 256 for b in range(256))
+
+
+def _die_with_parent(sig=None):
+    """
+    Have the kernel kill this process if its parent exits, so stressors
+    aren't left running as orphans. Only supported on Linux.
+
+    :param sig: the signal to be sent when the parent exits. None is SIGKILL
+    :return: None
+    """
+    if not sys.platform.startswith("linux"):
+        return
+    if sig is None:
+        sig = signal.SIGKILL
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.prctl(_PR_SET_PDEATHSIG, sig, 0, 0, 0)
+
+    # The parent may have exited before the prctl call took effect
+    parent = multiprocessing.parent_process()
+    if parent is not None and os.getppid() != parent.pid:
+        os._exit(1)
+
+
+def _get_context():
+    """
+    Get the multiprocessing context to start stressors with. On Linux this
+    forks directly, so the starting process is the child's real parent (as
+    _die_with_parent expects) rather than a fork server.
+
+    :return: the multiprocessing context to use
+    """
+    if sys.platform.startswith("linux"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing
+
+
+def _spin(ram_per_core_mb, cpu_id=None, barrier=None):
     """
     Spin in an infinite loop, consuming up to ram_per_core_mb.
 
     :param ram_per_core_mb: How many MB of RAM to consume in loop.
+    :param cpu_id: CPU to pin this process to. None leaves it unpinned
+    :param barrier: if given, wait on it before starting to consume resources
     :return: None
     """
-    me = psutil.Process()
+    _die_with_parent()
 
-    steps = 8
-    ram_per_step_mb = int(ram_per_core_mb / steps)
+    # A broken barrier means the parent gave up waiting -- start anyway
+    if barrier is not None:
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
 
-    dummy = list([1.0])
-    while True:
-        # Allocate RAM until resident set size (rss) reaches target
-        if me.memory_info().rss < ram_per_core_mb * 1024 * 1024:
-            try:
-                num = 1.0
-                dummy += [num] * int(ram_per_step_mb / sys.getsizeof(num) * 1024 * 1024)
+    # Stay on one CPU so the scheduler doesn't migrate a process that owns a
+    # lot of dirty memory between cores
+    if cpu_id is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu_id})
 
-            except MemoryError:
-                # We didn't have enough RAM for our attempt, so we will recursively try
-                # smaller amounts 10% smaller at a time
-                ram_per_step_mb = int(ram_per_step_mb * 0.8)
+    target_bytes = max(ram_per_core_mb * 1024 * 1024, PAGE_SIZE)
 
-        # Do something with dummy to try and keep it in active RAM
-        for i, n in enumerate(dummy):
-            dummy[i] += 1.010101
+    # Reserve the RAM as one contiguous anonymous mapping. It is made private
+    # where possible, as shared mappings aren't eligible for huge pages. If
+    # there isn't enough RAM, keep halving the request until it succeeds
+    while True:
+        try:
+            if hasattr(mmap, "MAP_PRIVATE"):
+                dummy = mmap.mmap(-1, target_bytes, flags=mmap.MAP_PRIVATE)
+            else:
+                dummy = mmap.mmap(-1, target_bytes)
+            break
+        except (MemoryError, OSError):
+            if target_bytes <= PAGE_SIZE:
+                raise
+            target_bytes //= 2
+
+    # Ask for transparent huge pages, so sweeping the buffer doesn't spend
+    # most of its time on TLB misses. Best effort only -- kernels without THP
+    # support reject the advice
+    if hasattr(mmap, "MADV_HUGEPAGE"):
+        try:
+            dummy.madvise(mmap.MADV_HUGEPAGE)
+        except OSError:
+            pass
+
+    while True:
+        # Increment every byte to try and keep it in active RAM. Done a block
+        # at a time, with several passes over each block while it is still in
+        # cache, so both the caches and main memory get exercised
+        for start in range(0, target_bytes, TOUCH_BLOCK_SIZE):
+            end = start + TOUCH_BLOCK_SIZE
+            block = dummy[start:end]
+            for _ in range(TOUCH_PASSES):
+                block = block.translate(_INCREMENT)
+            dummy[start:end] = block
 
 
 def _parse_args():
@@ -64,32 +150,79 @@ def _parse_args():
 
 def stress_processes(num_processes, ram_per_core_mb):
     """
-    Starts a given number infinite processing loops. Pauses briefly between
-    starting each process, and will restart processes that are killed by the
-    OS. Does not return.
+    Starts a given number infinite processing loops, and will restart
+    processes that are killed by the OS. Does not return.
 
     :param num_processes: the number of processes to spin
     :param ram_per_core_mb: amount of RAM each process should try and use
     :return: None
     """
+    _die_with_parent()
+
+    # Spread the processes over the CPUs we're allowed to run on, one each
+    cpus = [None]
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+
+    # Forking the workers takes milliseconds and re-imports nothing, so the
+    # starts don't need staggering
+    context = _get_context()
 
+    # Hold the workers at a barrier until they have all been started, then
+    # release them together
+    barrier = context.Barrier(num_processes + 1)
+
+    processes = []
+    started = []
     for i in range(num_processes):
-        p = multiprocessing.Process(target=_spin, args=(ram_per_core_mb,))
+        p = context.Process(target=_spin, args=(ram_per_core_mb, cpus[i % len(cpus)], barrier))
         p.start()
+        processes.append(p)
+        started.append(time.monotonic())
         print(f"Started process #{i} ({p.pid}) at {time.asctime()}")
-        time.sleep(1)
 
-    # Now wait, and check children. If it appears one has been killed,
-    # respawn
+    # If a worker died before reaching the barrier, don't wait for it forever.
+    # Timing out breaks the barrier, which releases the others too
+    try:
+        barrier.wait(timeout=BARRIER_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass
+
+    # Now block until a child exits. If one has been killed, respawn it. This
+    # is parent process of CPU stressors -- don't thrash CPU polling them
     while True:
-        children = multiprocessing.active_children()
-        if len(children) < num_processes:
-            p = multiprocessing.Process(target=_spin, args=(ram_per_core_mb,))
-            p.start()
-            print(f"Only {len(children)}/{num_processes} running - respawned {p.pid}")
+        exited = multiprocessing.connection.wait([p.sentinel for p in processes])
+        for i, p in enumerate(processes):
+            if p.sentinel in exited:
+                p.join()
+
+                # A worker that fails straight after starting will probably
+                # fail again, so back off rather than respawning in a hot loop.
+                # Workers killed by a signal (e.g. the OOM killer) have a
+                # negative exit code and are respawned immediately
+                if p.exitcode > 0 and time.monotonic() - started[i] < RESPAWN_MIN_UPTIME:
+                    time.sleep(RESPAWN_BACKOFF)
 
-        # This is parent process of CPU stressors -- don't thrash CPU
-        time.sleep(2)
+                processes[i] = context.Process(target=_spin, args=(ram_per_core_mb, cpus[i % len(cpus)]))
+                processes[i].start()
+                started[i] = time.monotonic()
+                print(f"Process #{i} ({p.pid}) exited - respawned {processes[i].pid}")
+
+
+def _preallocate(fd, size):
+    """
+    Reserve the file's extents up front so writes don't have to wait on block
+    allocation. Best effort only -- writing works without it.
+
+    :param fd: file descriptor of the file to preallocate
+    :param size: number of bytes to reserve
+    :return: None
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
 
 
 def stress_io(write_mb_per_second, max_file_size_mb=None):
@@ -101,26 +234,80 @@ def stress_io(write_mb_per_second, max_file_size_mb=None):
     :param max_file_size: Written file won't exceed this. None is "unlimited"
     :return: None
     """
-    tf = tempfile.NamedTemporaryFile(prefix="stress_io_", suffix=".tmp")
-    print(f"Writing {write_mb_per_second:,} MB/s to file: {tf.name} (max={max_file_size_mb:,} MB)")
-
-    write_bytes = write_mb_per_second * 1024 * 1024
-    max_bytes = None
-    if max_file_size_mb:
-        max_bytes = max_file_size_mb * 1024 * 1024
+    # Exit through the finally below on SIGTERM, so the file is cleaned up
+    # when our parent dies
+    signal.signal(signal.SIGTERM, lambda x, y: sys.exit(1))
+    _die_with_parent(signal.SIGTERM)
 
+    fd, path = tempfile.mkstemp(prefix="stress_io_", suffix=".tmp")
+    chunk = None
     try:
+        max_desc = f"{max_file_size_mb:,} MB" if max_file_size_mb else "unlimited"
+        print(f"Writing {write_mb_per_second:,} MB/s to file: {path} (max={max_desc})")
+
+        # Bypass the page cache so the writes actually reach the device. Fall
+        # back to synchronous buffered writes where O_DIRECT isn't supported
+        # (e.g. tmpfs)
+        o_direct = getattr(os, "O_DIRECT", 0)
+        o_dsync = getattr(os, "O_DSYNC", 0)
+        try:
+            direct_fd = os.open(path, os.O_WRONLY | o_direct | o_dsync)
+        except OSError:
+            direct_fd = os.open(path, os.O_WRONLY | o_dsync)
+        os.close(fd)
+        fd = direct_fd
+
+        write_bytes = write_mb_per_second * 1024 * 1024
+        max_bytes = None
+        if max_file_size_mb:
+            max_bytes = max_file_size_mb * 1024 * 1024
+            _preallocate(fd, max_bytes)
+
+        # Each write is submitted as a batch of fixed size chunks in one
+        # syscall. The chunk is mmap'd so it is page aligned, as O_DIRECT
+        # requires
+        chunk = mmap.mmap(-1, IO_CHUNK_SIZE)
+        chunk.write(b'0' * IO_CHUNK_SIZE)
+        batch = [chunk] * IO_BATCH_SIZE
+
+        # Pace the writes with a token bucket: credit accrues continuously at
+        # write_bytes per second (capped at one second's worth), and chunks
+        # are submitted whenever there is credit for them
         bytes_written = 0
+        credit = 0.0
+        last = time.monotonic()
         while True:
+            now = time.monotonic()
+            credit = min(write_bytes, credit + (now - last) * write_bytes)
+            last = now
+
+            count = min(IO_BATCH_SIZE, int(credit // IO_CHUNK_SIZE))
+            if not count:
+                time.sleep((IO_CHUNK_SIZE - credit) / write_bytes)
+                continue
+
+            # Start each cycle from an empty file, so blocks are released
+            # rather than overwritten in place. Only the first cycle writes
+            # into preallocated extents
             if max_bytes and bytes_written >= max_bytes:
-                tf.seek(0)
-
-            tf.write(b'0' * write_bytes)
-            bytes_written += write_bytes
-            time.sleep(1)
+                os.ftruncate(fd, 0)
+                os.lseek(fd, 0, os.SEEK_SET)
+                bytes_written = 0
+
+            if hasattr(os, "writev"):
+                written = os.writev(fd, batch[:count])
+            else:
+                written = 0
+                for _ in range(count):
+                    written += os.write(fd, chunk)
+            credit -= written
+            bytes_written += written
 
     finally:
-        tf.close()
+        os.close(fd)
+        os.unlink(path)
+        if chunk is not None:
+            chunk.close()
 
 
 def _cmd_line():
@@ -150,12 +337,12 @@ def _cmd_line():
         # The CPU stress has to happen in another process since it is infinitely
         # CPU hungry. Each process will consume RAM.
         print(f"Starting {cores_to_stress} CPU/RAM stressors which will consume up to {memory_per_core:,} MB each")
-        multiprocessing.Process(target=stress_processes, args=(cores_to_stress, memory_per_core,)).start()
+        _get_context().Process(target=stress_processes, args=(cores_to_stress, memory_per_core,)).start()
 
     if io_to_stress:
         # IO stress also in another process, constantly writing to disk
         print(f"Starting IO stressor which will write {io_to_stress:,} MB/s")
-        multiprocessing.Process(target=stress_io, args=(io_to_stress, max_file_size)).start()
+        _get_context().Process(target=stress_io, args=(io_to_stress, max_file_size)).start()
 
 
 if __name__ == '__main__':